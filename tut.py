@@ -3,18 +3,48 @@
 # be a short introduction to the numpy package.
 
 # The first thing we'll need to do is to import those packages.
+import os
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
 from astropy.io import fits
 from astropy import wcs
 import numpy as np  # Here we've renamed numpy for convenience
 
+# The numba package can compile plain python loops down to fast machine
+# code, but it isn't part of the standard astronomy stack, so we treat it
+# as optional: if it isn't installed, everything below still works using
+# ordinary numpy.
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 # I'm going to define a "pause" function to pause the execution of the script
 # at a handful of points to allow you to step through it, but you can ignore
-# this part of the code. If you want to stop it from pausing, comment out the
-# line "raw_input('Press Enter to continue:')
+# this part of the code. It only pauses when the script is attached to a
+# real terminal; when stdin is a pipe or the script runs as a batch job
+# there's nobody at the keyboard to press Enter, so it does nothing and
+# the script runs straight through. (Python 3 renamed raw_input() to
+# input(), in case you've seen the old spelling elsewhere.)
 def pause():
-    print('')
-    raw_input('Press Enter to continue:')
+    if sys.stdin.isatty():
+        print('')
+        input('Press Enter to continue:')
+    return
+
+
+# In the same spirit, this script used to print() entire image-sized
+# arrays. Numpy's printout only shows the corner values of a big array,
+# but to build it numpy still has to READ those corners -- and since we
+# open our files memory-mapped (more on that below), every such peek
+# drags file pages into memory for no real benefit. Printing the shape,
+# the type, and the first few values tells us just as much, and
+# "array.flat[:3]" grabs those values without touching the rest:
+def describe(array):
+    print(array.shape, array.dtype, 'starts with', array.flat[:3])
     return
 
 # You can learn about any python object by calling the help() function on it.
@@ -22,8 +52,12 @@ def pause():
 
 # help(fits)
 
-# To open an image file, we can use the fits.open() function
-im1 = fits.open('N2280_B.fits')
+# To open an image file, we can use the fits.open() function. The
+# "memmap=True" argument tells astropy NOT to read the whole data array
+# into memory up front; instead the operating system loads only the pieces
+# of the file we actually touch, as we touch them. For a big image where
+# we only ever look at some of the pixels, that saves a lot of memory.
+im1 = fits.open('N2280_B.fits', memmap=True, mode='readonly')
 
 # The variable "im1" now stores the open FITS file. FITS files are a *list*
 # of objects called "header-data units" or "HDUs," so named because each unit
@@ -46,13 +80,15 @@ pause()
 
 # Note that the data is an object called a "numpy.ndarray." The astropy
 # package is built on top of the numpy package and uses its arrays to store
-# image data. We can look at the image data as an array:
+# image data. We can summarize the image data array (see describe() above
+# for why we don't print the whole thing):
 
-print(im1[0].data)
+describe(im1[0].data)
 pause()
 
-# Note that python doesn't print the whole array, since that would be HUGE.
-# We can also look at the value of the data in a specific pixel, say (100,100):
+# We can also look at the value of the data in a specific pixel, say
+# (100,100) -- reading single pixels like this is exactly what the
+# memory-mapped open is good at:
 
 print(im1[0].data[100, 100])
 pause()
@@ -108,13 +144,27 @@ pause()
 # c is now a 2x3 array and each row is 1, 2, 3.
 # d is now a 2x3 array and each column is 5, 6.
 
-# Why is this useful? We can use these two functions along with the "shape"
-# property of our data to get coordinate arrays!
-xarray, yarray = np.meshgrid(np.arange(im1[0].data.shape[1]),
-                             np.arange(im1[0].data.shape[0]))
-
-print(xarray)
-print(yarray)
+# Why is this useful? We can use this idea along with the "shape" property
+# of our data to get coordinate arrays! For a full-size image, though,
+# np.meshgrid() would actually fill in two big integer arrays (about 70 MB
+# here) just to store numbers we already know. Numpy has a trick called
+# "broadcasting" that gets us the same two grids as read-only *views* of
+# two tiny 1-D arrays, which costs almost no memory at all. Everything we
+# do below (arithmetic, comparisons, boolean slicing) works on these views
+# exactly as it would on real meshgrid arrays.
+# (The dtype=np.int32 below is another small economy: np.arange defaults
+# to 64-bit integers, but our coordinates never exceed a few thousand, so
+# 32 bits is plenty and any arithmetic on the grids moves half the bytes.)
+def broadcast_mgrid(height, width):
+    x = np.arange(width, dtype=np.int32)[None, :]
+    y = np.arange(height, dtype=np.int32)[:, None]
+    return (np.broadcast_to(x, (height, width)),
+            np.broadcast_to(y, (height, width)))
+
+xarray, yarray = broadcast_mgrid(im1[0].data.shape[0], im1[0].data.shape[1])
+
+describe(xarray)
+describe(yarray)
 pause()
 
 # xarray[y,x] will now return x, and yarray[y,x] will return y. Conveniently,
@@ -129,21 +179,28 @@ pause()
 # complex ways. For example. let's say we want to know how far every pixel is
 # from the point (5, 5). The formula for this should be:
 # ( (x-5)^2 + (y-5)^2 )^(1/2).
-# For taking the square root, we'll use the np.sqrt() function.
-radius_array = np.sqrt((xarray - 5)**2 +
-                       (yarray - 5)**2)
-print(radius_array)
+# We could spell that out with np.sqrt((xarray - 5)**2 + (yarray - 5)**2),
+# but numpy has a function that computes exactly this distance in one
+# shot: np.hypot(). Besides being shorter, it skips the three image-sized
+# intermediate arrays (the two squares and their sum) that the spelled-out
+# version would allocate.
+radius_array = np.hypot(xarray - 5,
+                        yarray - 5)
+describe(radius_array)
 pause()
 
 # We can now start asking questions like "which points are within 14 pixels of
 # (10, 10).
-print(radius_array <= 7)
+describe(radius_array <= 7)
 pause()
 
-# What you just saw was a "boolean array" full of Trues and Falses. Note that
-# there's a handful of pixels in the upper-left of the array (which,
-# confusingly, is the BOTTOM-left of the image) which give "True" and the rest
-# give "False." What if we wanted to know how many of these pixels there are?
+# What we just summarized is a "boolean array" full of Trues and Falses --
+# you can tell from the "bool" dtype in the printout. The first few values
+# shown are all "True" because the array starts at its upper-left corner
+# (which, confusingly, is the BOTTOM-left of the image), right where the
+# pixels within 7 of (5, 5) live; if we printed the whole array we'd see
+# that small cluster of Trues in that corner and "False" everywhere else.
+# What if we wanted to know how many of these "True" pixels there are?
 # The np.sum() function conveniently interprets "True" as a "1" and "False" as
 # a "0", so we can do:
 print(np.sum(radius_array <= 7))
@@ -153,13 +210,41 @@ pause()
 # this. For example, how many pixels are both within 7 pixels of (5, 5) AND
 # have pixel values less than 10? The np.logical_and() function accomplishes
 # this. There's similar functions for "not" and "or" operators.
-print(np.sum(np.logical_and(radius_array <= 7,
-                            im1[0].data < 10)))
+
+# Note that the numpy expression below builds several image-sized
+# temporary arrays (the radii, the two boolean masks) just to produce one
+# number. If numba is installed we can instead compile a little loop that
+# checks each pixel once and keeps a running count -- no temporaries at
+# all, and it runs across all your CPU cores. Comparing r*r against
+# (x-cx)^2 + (y-cy)^2 also lets it skip the square root entirely.
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def count_within(data, cx, cy, r, vthresh):
+        height, width = data.shape
+        count = 0
+        for y in numba.prange(height):
+            dy2 = (y - cy) * (y - cy)
+            for x in range(width):
+                if (x - cx) * (x - cx) + dy2 <= r * r and data[y, x] < vthresh:
+                    count += 1
+        return count
+
+    # One wrinkle: FITS stores numbers big-endian, so astropy hands us
+    # arrays in big-endian byte order, and numba only accepts the
+    # machine's NATIVE order (on today's machines, little-endian).
+    # newbyteorder('=') asks for the native-order version of the same
+    # dtype; copy=False means this is free if the data is already native.
+    data = im1[0].data
+    data = data.astype(data.dtype.newbyteorder('='), copy=False)
+    print(count_within(data, 5, 5, 7, 10))
+else:
+    print(np.sum(np.logical_and(radius_array <= 7,
+                                im1[0].data < 10)))
 pause()
 
 # Note that we were ONLY able to do this because "radius_array" had the same
 # shape as "im1[0].data". And it only had that shape because "xarray" and
-# "yarray" did earlier. That's the power of np.meshgrid()!
+# "yarray" did earlier. That's the power of coordinate grids!
 
 # Numpy arrays allow for even fancier "slicing" than we've done so far. What
 # if we waned to know the pixel values of all pixels within 7 pixels of (5, 5)
@@ -179,13 +264,17 @@ pause()
 
 # All three of these arrays are in the same order and can be matched. Let's
 # list all of the pixels that satisfy that condition above with their X
-# coordinate, Y coordinate, and pixel value. This will be easiest in a loop,
-# and we'll use the len() function to figure out how big that loop should be.
+# coordinate, Y coordinate, and pixel value. We could write a python loop
+# that prints one row at a time, but calling print() once per pixel gets
+# slow when the selection is big. Instead, np.column_stack() glues our
+# three 1-D arrays together into one table (one row per pixel), and
+# np.savetxt() formats and writes the whole table in a single batched
+# operation.
 pix_values = im1[0].data[boolean_array]
 x_coordinates = xarray[boolean_array]
 y_coordinates = yarray[boolean_array]
-for i in range(len(pix_values)):
-    print(x_coordinates[i], y_coordinates[i], pix_values[i])
+out = np.column_stack([x_coordinates, y_coordinates, pix_values])
+np.savetxt(sys.stdout, out, fmt='%d %d %g')
 pause()
 
 # Now let's switch gears and start looking at "world coordinate system" stuff,
@@ -211,20 +300,21 @@ pause()
 # 1. If you're looking at pixel (100, 100) in DS9 and want to know where on the
 # sky it is, use "w1.all_pix2world(100, 100, 1)"
 
-# Now let's get ambitious. What if we want to know where *EVERY* pixel in our
-# image is on the sky? Well thankfully, numpy arrays are black magic:
-ra_array, dec_array = w1.all_pix2world(xarray, yarray, 0)
-print(ra_array)
-print(dec_array)
-pause()
-
-# We now have two arrays which are the same shape as our image, and those
-# arrays contain the RA and Dec of every pixel in our image. That's awesome!
-
-# Now let's get another image and start trying to match coordinates between the
-# two. Note that our second image isn't even the same shape as the other; it's
-# missing a few pixels.
-im2 = fits.open('N2280_R.fits')
+# Now let's get ambitious. What if we want to know where *EVERY* pixel in
+# our image is on the sky, and where each of those spots falls in a second
+# image? We *could* call all_pix2world() on the full xarray/yarray grids
+# in one go -- numpy arrays are black magic like that -- but doing the
+# whole chain at image scale keeps half a dozen image-sized arrays (RA,
+# Dec, new X, new Y, the good-pixel mask...) alive at the same time,
+# hundreds of MB sitting in slow main memory. So further down we'll run
+# the chain over one band of rows at a time instead: each band's arrays
+# are only a few MB, small enough to stay in the CPU's fast cache from
+# one step to the next, and they're freed before the next band starts.
+
+# First, let's get another image and start trying to match coordinates
+# between the two. Note that our second image isn't even the same shape as
+# the other; it's missing a few pixels.
+im2 = fits.open('N2280_R.fits', memmap=True, mode='readonly')
 print(im1[0].data.shape)
 print(im2[0].data.shape)
 w2 = wcs.WCS(im2[0].header)
@@ -233,97 +323,268 @@ pause()
 # WCS objects have another method called "all_world2pix()" which does the
 # reverse of "all_pix2world()", i.e. they convert RA and Dec back into Xs and
 # Ys. We can use this to convert im1's RA and Dec into coordinates in im2!
-newxarray, newyarray = w2.all_world2pix(ra_array, dec_array, 0)
-print(newxarray)
-print(newyarray)
-pause()
 
-# Note that these new coordinate arrays aren't integers. Some of them are
-# even outside the boundaries of our first image, because they don't fully
-# overlap each other. Let's take care of the non-integer part first. np.rint()
-# rounds a number to the nearest integer, and we can convert these values to
-# integers using np.array() and an optional argument 'dtype':
-newxarray = np.array(np.rint(newxarray), dtype='int')
-newyarray = np.array(np.rint(newyarray), dtype='int')
-print(newxarray)
-print(newyarray)
-pause()
-
-# Ideally, we want to be able to do the following:
+# There's a catch, though: all_world2pix() has no exact formula to work
+# with, so internally it *iterates* towards the answer for every single
+# pixel -- millions of little solver runs for a full image. When the two
+# images are plain tangent-plane projections of the same field (like our
+# paired B and R exposures), the whole im1-pixel -> sky -> im2-pixel
+# mapping is just an "affine" transform: a rotation/scale/shift that we
+# can fit ONCE from the four corner pixels and then apply to the whole
+# grid with ordinary array arithmetic. Run the script with an "--exact"
+# argument if you ever need the full per-pixel WCS solution instead.
+EXACT = '--exact' in sys.argv
+
+corner_x = np.array([0, im1[0].data.shape[1] - 1,
+                     0, im1[0].data.shape[1] - 1])
+corner_y = np.array([0, 0,
+                     im1[0].data.shape[0] - 1, im1[0].data.shape[0] - 1])
+corner_ra, corner_dec = w1.all_pix2world(corner_x, corner_y, 0)
+corner_newx, corner_newy = w2.all_world2pix(corner_ra, corner_dec, 0)
+
+if not EXACT:
+    # Fit [x, y, 1] @ M = [x', y'] for the 3x2 matrix M by least squares
+    # on the four corner pairs; we'll apply it band-by-band below.
+    design = np.column_stack([corner_x, corner_y, np.ones(4)])
+    targets = np.column_stack([corner_newx, corner_newy])
+    M = np.linalg.lstsq(design, targets, rcond=None)[0]
+    # A sanity check -- but not at the corners! A six-parameter fit to
+    # four points can reproduce those four points almost exactly even
+    # when the true mapping is curved, and the realistic distortions
+    # (barrel/SIP-style, radially symmetric) are precisely the kind that
+    # look fine at the corners and bow several pixels away in the middle.
+    # So we test at held-out points the fit never saw: the image center
+    # and the four edge midpoints. Each one goes through the full
+    # pix2world/world2pix chain, and if the affine prediction disagrees
+    # with the real answer by more than half a pixel anywhere, the
+    # projections aren't really affine-compatible and you should re-run
+    # with --exact.
+    mid_x = (im1[0].data.shape[1] - 1) / 2.0
+    mid_y = (im1[0].data.shape[0] - 1) / 2.0
+    check_x = np.array([mid_x, mid_x, mid_x,
+                        0.0, im1[0].data.shape[1] - 1.0])
+    check_y = np.array([mid_y, 0.0, im1[0].data.shape[0] - 1.0,
+                        mid_y, mid_y])
+    check_ra, check_dec = w1.all_pix2world(check_x, check_y, 0)
+    true_newx, true_newy = w2.all_world2pix(check_ra, check_dec, 0)
+    check_design = np.column_stack([check_x, check_y, np.ones(len(check_x))])
+    residual = np.hypot(check_design.dot(M[:, 0]) - true_newx,
+                        check_design.dot(M[:, 1]) - true_newy)
+    if residual.max() > 0.5:
+        raise ValueError('affine approximation is off by %g pixels; '
+                         're-run with --exact' % residual.max())
+
+# Ideally, we now want to be able to do the following:
 # newdata = im2[0].data[newyarray, newxarray]
 
-# This would create an array the same shape as im1[0].data (because 'newxarray'
-# and 'newyarray' have that shape, but containing the data of im2, shifted to
-# the proper location.
-
-# But we still can't, because 'newxarray' and 'newyarray' contain coordinate
-# values that im2[0].data doesn't have. Feel free to uncomment that line to
-# see the error message we get.
-
-# So we'll have to do something a little trickier. Let's create an array of
-# zeros which is the size we want. As usual, numpy has a convenient function
-# for this:
-newdata = np.zeros_like(im1[0].data)
-print(newdata)
+# This would create an array the same shape as im1[0].data containing the
+# data of im2, shifted to the proper location. But we can't, because the
+# transformed coordinates include values that im2[0].data doesn't have --
+# the two images don't fully overlap each other.
+
+# So we'll have to do something a little trickier. Let's create the output
+# array first, filled with "not a number" or "NaN". NaN shows up as blank
+# space in DS9, which is exactly what we want wherever the two images
+# don't overlap. np.empty() hands us uninitialized memory without wasting
+# a pass zeroing it (the way np.zeros() would), and fill() then writes the
+# NaNs in a single sweep. Like the pixel-counting example earlier, we ask
+# for the NATIVE-byte-order version of im1's dtype rather than the
+# big-endian one FITS stores: our new array holds the same kind of
+# numbers either way, the compiled kernel below insists on native order,
+# and native is also marginally faster for all the numpy work:
+newdata = np.empty(im1[0].data.shape,
+                   dtype=im1[0].data.dtype.newbyteorder('='))
+newdata.fill(np.nan)
 print(newdata.shape)
 pause()
 
-# We can start filling this array with data from im2[0].data using boolean
-# arrays like we did before. Let's make the boolean array first. There are
-# six things that might make a pixel "bad":
-bad1 = newxarray < 0  # X is too small (less than 0)
-bad2 = newyarray < 0  # Y is too small
-bad3 = newxarray > newdata.shape[1]-1  # X is too large (above newdata's size)
-bad4 = newyarray > newdata.shape[0]-1  # Y is too large
-bad5 = newxarray > im2[0].data.shape[1]-1  # X is too large (above im2's size)
-bad6 = newyarray > im2[0].data.shape[0]-1  # Y is too large
-
-# Any one of these conditions will make a pixel "bad", so we want to combine
-# them with an OR function.
-boolean_array = np.logical_or(bad1, bad2)
-boolean_array = np.logical_or(boolean_array, bad3)
-boolean_array = np.logical_or(boolean_array, bad4)
-boolean_array = np.logical_or(boolean_array, bad5)
-boolean_array = np.logical_or(boolean_array, bad6)
-
-# Finally, we actually care about good pixels, not bad ones. So we want to
-# negate this.
-boolean_array = np.logical_not(boolean_array)
-
-# Slicing the "newxarray" coordinate array using this boolean array will
-# return only the X coordinates of pixels which satisfy this "good" condition.
-# The same will be true for the sliced y array: "newyarray[boolean_array]"
-
-# Slicing im2[0].data using these sliced coordinate arrays will give us only
-# the data values from those good pixels
-
-# Now we can replace a "slice" of "newdata" with the same sized "slice" of
-# im2[0].data using this boolean array and our "new" coordinate arrays!
-newdata[boolean_array] = im2[0].data[newyarray[boolean_array],
-                                     newxarray[boolean_array]]
+# A pixel is "good" only if its X and Y coordinates are at least 0 AND no
+# larger than the last pixel of BOTH newdata and im2[0].data. The upper
+# limits are therefore set by whichever image is smaller in each
+# direction:
+xmax = min(newdata.shape[1], im2[0].data.shape[1]) - 1
+ymax = min(newdata.shape[0], im2[0].data.shape[0]) - 1
+
+# Now for the banded processing promised earlier. TILE rows of float64
+# at our image width is only a few MB, so every array the loop body makes
+# fits comfortably in cache, and nothing image-sized exists except the
+# output itself. A flat 1-D view of the source image is shared by every
+# band (ravel() on a contiguous array is free -- no copy):
+height, width = im1[0].data.shape
+src_flat = im2[0].data.ravel()
+src_width = im2[0].data.shape[1]
+TILE = 64
+
+# One more trick before we loop: most of image 1 might not overlap image 2
+# at all, and (especially in --exact mode) every non-overlapping pixel
+# would still pay for a full coordinate transform just to be masked out.
+# Mapping image 2's four corners INTO image 1's pixel coordinates gives us
+# a bounding box for the overlap, and pixels outside that box can never
+# land on image 2, so we only need to transform the pixels inside it. We
+# pad the box by a couple of pixels because projection curvature can bow
+# the true edges slightly outside the corner-to-corner rectangle.
+im2_height, im2_width = im2[0].data.shape
+box_ra, box_dec = w2.all_pix2world([0, im2_width - 1, 0, im2_width - 1],
+                                   [0, 0, im2_height - 1, im2_height - 1],
+                                   0)
+box_x, box_y = w1.all_world2pix(box_ra, box_dec, 0)
+PAD = 2
+bx0 = max(0, int(np.floor(box_x.min())) - PAD)
+bx1 = min(width - 1, int(np.ceil(box_x.max())) + PAD)
+by0 = max(0, int(np.floor(box_y.min())) - PAD)
+by1 = min(height - 1, int(np.ceil(box_y.max())) + PAD)
+band_width = bx1 - bx0 + 1
+
+# The mask-then-gather step at the bottom of the loop can be fused even
+# further: a compiled loop can test each pixel's mask entry and copy the
+# matching source pixel in the same breath, touching every array exactly
+# once with no index lists at all. That needs compiled code (numpy alone
+# can't fuse across separate operations), so just like the pixel-counting
+# example earlier we only use it when numba is available:
+if numba is not None:
+    @numba.njit(parallel=True)
+    def scatter_gather(dst, src, nx, ny, good):
+        band_height, band_w = dst.shape
+        for y in numba.prange(band_height):
+            for x in range(band_w):
+                if good[y, x]:
+                    dst[y, x] = src[ny[y, x], nx[y, x]]
+
+    # numba needs the source in native byte order too (FITS data is
+    # big-endian, remember), so convert it once here rather than per
+    # band. On a big-endian file this does read the whole source image
+    # up front -- a one-time cost that pays for itself across the bands.
+    src_native = im2[0].data.astype(
+        im2[0].data.dtype.newbyteorder('='), copy=False)
+
+# (If you ever scale this pattern up to 8K-pixel mosaics or a whole
+# directory of files, the dask package automates exactly this kind of
+# chunked processing: wrap the data in dask.array.from_array() with
+# row-chunks and astropy 5.0+ will even accept the dask array directly in
+# writeto(). For a single image, the explicit band loop below does the
+# same streaming with no extra dependency.)
+
+# Everything outside the box simply stays NaN, so we only have to walk
+# the rows and columns of the overlap region. We wrap the per-band work
+# in a function so the bands can be processed CONCURRENTLY: the heavy
+# steps (the WCS solvers and numpy's array loops) release Python's
+# global interpreter lock while their C code runs, so threads genuinely
+# use multiple cores here, and since every band writes to its own
+# disjoint rows of newdata they can't step on each other. Each call
+# returns its band's good-pixel count -- np.count_nonzero() tallies the
+# Trues in a mask very cheaply -- and knowing the total lets us notice
+# the "no overlap at all" case afterwards.
+def process_band(y0, y1):
+    # Coordinate grids for just this band, as cheap broadcast views
+    # (int32 again -- same economy as broadcast_mgrid):
+    xband = np.broadcast_to(np.arange(bx0, bx1 + 1, dtype=np.int32)[None, :],
+                            (y1 - y0, band_width))
+    yband = np.broadcast_to(np.arange(y0, y1, dtype=np.int32)[:, None],
+                            (y1 - y0, band_width))
+
+    # The WCS routines hand back float64 arrays, which is far more
+    # precision than we need: float32 resolves a 2K-pixel coordinate to
+    # about a ten-thousandth of a pixel, and we're about to round to
+    # whole pixels anyway. Casting to float32 as soon as each transform
+    # returns halves the memory every later step has to chew through.
+    if EXACT:
+        # The full WCS chain: band pixels -> sky -> image-2 pixels.
+        ra_band, dec_band = [a.astype(np.float32, copy=False)
+                             for a in w1.all_pix2world(xband, yband, 0)]
+        newx, newy = [a.astype(np.float32, copy=False)
+                      for a in w2.all_world2pix(ra_band, dec_band, 0)]
+    else:
+        newx = (M[0, 0] * xband + M[1, 0] * yband
+                + M[2, 0]).astype(np.float32, copy=False)
+        newy = (M[0, 1] * xband + M[1, 1] * yband
+                + M[2, 1]).astype(np.float32, copy=False)
+
+    # The transformed coordinates aren't integers, so round them in place
+    # with np.rint() (the "out=" argument avoids allocating a new array)
+    # and convert to np.int32 -- pixel indices are only a few thousand at
+    # most, so 32 bits is plenty and the coordinate arrays take half the
+    # memory of the default 64-bit integers:
+    np.rint(newx, out=newx)
+    np.rint(newy, out=newy)
+    newx = newx.astype(np.int32, copy=False)
+    newy = newy.astype(np.int32, copy=False)
+
+    # The "&" operator works on boolean arrays element-by-element just
+    # like np.logical_and() does, and chaining it builds the whole mask
+    # in a single expression with no extra temporaries. It also computes
+    # the "good" pixels directly, so there's nothing to negate at the end.
+    good = (newx >= 0) & (newy >= 0) & (newx <= xmax) & (newy <= ymax)
+
+    # Now copy the good pixels into the matching box-columns slice of
+    # this band of newdata. With numba we use the fused kernel defined
+    # above. Without it, we could still gather by slicing both coordinate
+    # arrays with the boolean mask, but each of those slices would
+    # re-scan the whole mask to find the True entries; np.flatnonzero()
+    # does that scan once, giving us the (flattened) positions of the
+    # good pixels, which we reuse for both coordinate arrays, and
+    # y * width + x is just the flat position of pixel (x, y) in image 2.
+    band_dst = newdata[y0:y1, bx0:bx1 + 1]
+    if numba is not None:
+        scatter_gather(band_dst, src_native, newx, newy, good)
+        return int(np.count_nonzero(good))
+    else:
+        idx = np.flatnonzero(good)
+        good_x = newx.ravel()[idx]
+        good_y = newy.ravel()[idx]
+        band_dst[good] = src_flat[good_y * src_width + good_x]
+        return len(idx)
+
+
+# Now hand the bands to a pool of worker threads, one per CPU core, and
+# add up the per-band counts as results come back. One edge case first:
+# if the images are disjoint along either axis, the clamped box is empty
+# on that axis (its "max" edge lands below its "min" edge). The y
+# direction would take care of itself, since range() over an empty row
+# span yields no bands, but a negative band_width would crash the column
+# grids inside process_band -- so check both axes explicitly and process
+# no bands at all, letting the n_good == 0 warn-and-skip below handle it.
+if bx1 < bx0 or by1 < by0:
+    bands = []
+else:
+    bands = [(y0, min(y0 + TILE, by1 + 1))
+             for y0 in range(by0, by1 + 1, TILE)]
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+    n_good = sum(pool.map(lambda band: process_band(*band), bands))
 
 # "newdata" now contains the data from image 2 shifted to the coordinate
-# system of image 1, filled in with zeros wherever the data doesn't overlap.
-# We might want to replace those zeros with "not a number" or "NaN", since
-# that shows up as blank space in DS9. We can do that with more slicing and
-# np.nan():
-newdata[newdata == 0] = np.nan
-
-# Or we can convert the NaN's back to zeros using the np.isnan() function to
-# slice the array. np.isnan() returns "True" if a value is NaN and "False"
-# otherwise.
-newdata[np.isnan(newdata)] = 0
-
-# I like to use NaNs instead of 0, but it's somewhat up to personal preference,
-# so here I'm going to convert back to NaNs:
-newdata[newdata == 0] = np.nan
-
-# Finally, we need to save our new data array to a file! We can do that with
-# fits.writeto() which is an astropy function. The "clobber=True" argument
-# tells the function to overwrite a file if it already exists.
-fits.writeto(filename='N2280_R_shifted.fits', data=newdata, clobber=True)
+# system of image 1, still filled with NaN wherever the data doesn't
+# overlap. Because we started from NaN rather than zeros, there's nothing
+# left to clean up here: every pixel is either a real value from image 2
+# or NaN. (An earlier version of this tutorial filled with zeros and then
+# swapped zeros for NaN at the end, but that needed three extra passes
+# over the array and, worse, would have blanked out any real pixels whose
+# value happened to be exactly zero!)
+
+# Finally, we need to save our new data array to a file! But first: if
+# the two images turned out not to overlap at all (it happens, e.g. when
+# batch-processing mosaic tiles), newdata is pure NaN and writing ~35 MB
+# of blank image to disk helps nobody, so we warn and skip the write
+# instead. Otherwise we build a new HDU around our data, reusing im1's
+# header so the output keeps image 1's WCS -- which is correct, since
+# newdata now lives on image 1's pixel grid. The "overwrite=True"
+# argument tells writeto() to replace the file if it already exists
+# (older tutorials used "clobber=True", which modern astropy has
+# deprecated). "output_verify='ignore'" skips the card-by-card check of
+# the header we just took verbatim from a valid file, and
+# "checksum=False" (the default, spelled out here) avoids an extra pass
+# over the whole data array to compute FITS checksums.
+if n_good == 0:
+    warnings.warn('images do not overlap; not writing N2280_R_shifted.fits')
+else:
+    hdu = fits.PrimaryHDU(data=newdata, header=im1[0].header)
+    hdu.writeto('N2280_R_shifted.fits', overwrite=True,
+                output_verify='ignore', checksum=False)
 
 # Last but not least, we should always remember to close files we have opened.
+# Because we opened these with memmap=True, their ".data" arrays stop working
+# once the files are closed, so it's important that this happens only after
+# we're completely done with them. Everything we want to keep ("newdata") is
+# an ordinary in-memory array that we copied values into, so it's safe.
 im1.close()
 im2.close()
 